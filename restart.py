@@ -1,13 +1,24 @@
 import argparse
+import concurrent.futures
 import datetime
 import glob
+import itertools
 import json
 import logging
 import pathlib
 import random
-import tempfile
+import re
 
 import boto3
+from botocore.config import Config
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 logging.getLogger().setLevel(logging.INFO)
@@ -18,6 +29,36 @@ logging.basicConfig(
 )
 
 
+def json_loads(json_bytes):
+    """Deserialize JSON bytes using orjson when available.
+
+    Parameters:
+    json_bytes (bytes): JSON document
+
+    Returns:
+    (object): data
+    """
+
+    if orjson:
+        return orjson.loads(json_bytes)
+    return json.loads(json_bytes)
+
+
+def json_dumps(data):
+    """Serialize data to indented JSON bytes using orjson when available.
+
+    Parameters:
+    data (object): JSON serializable data
+
+    Returns:
+    (bytes): json_bytes
+    """
+
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode()
+
+
 class Restart:
     """Class to restart exeuction of Step Function after failure."""
 
@@ -38,9 +79,17 @@ class Restart:
         "random_fail": "reaches.json"
     }
     JSON = [ "basin.json", "reaches.json", "hivdisets.json", "metrosets.json", "neosets.json", "sicsets.json" ]
-    S3 = boto3.client("s3")
-    SFN = boto3.client("stepfunctions")
+    MAX_WORKERS = 64
+    DELETE_BATCH_SIZE = 1000
+    DELETE_WORKERS = 8
+    CLIENT_CONFIG = Config(
+        max_pool_connections=MAX_WORKERS,
+        retries={"max_attempts": 5, "mode": "adaptive"},
+        tcp_keepalive=True,
+        read_timeout=30
+    )
     REACHES_OF_INTEREST = "reaches_of_interest.json"
+    CONTEXT_INDEX = re.compile(r'"context_index"\s*:\s*(\d+)')
 
     def __init__(self, input_dir, prefix, expanded, subset):
         """
@@ -51,15 +100,22 @@ class Restart:
         subset (str): Reach subset JSON file name
         """
 
+        session = boto3.session.Session()
+        self.s3 = session.client("s3", config=self.CLIENT_CONFIG)
+        self.sfn = session.client("stepfunctions", config=self.CLIENT_CONFIG)
         self.input_dir = pathlib.Path(input_dir)
         self.random_int = random.randint(100000, 999999)
         self.save_failures = {}
+        self.written_json = {}
+        self.map_keys = None
         self.s3_config = f"{prefix}-config"
         self.s3_json = f"{prefix}-json"
         self.s3_map = f"{prefix}-map-state"
+        self.MODULES_JSON = dict(Restart.MODULES_JSON)
+        self.JSON = list(Restart.JSON)
         if expanded:
             self.MODULES_JSON["input"] = f"expanded_{subset}"
-            self.JSON[1] = f"expanded_{subset}"
+            self.JSON = [json_name if json_name != "reaches.json" else f"expanded_{subset}" for json_name in Restart.JSON]
 
     def locate_failures(self):
         """Locate state task failures by parsing S3 bucket for map results."""
@@ -68,57 +124,115 @@ class Restart:
         failed_files = self.search_files("FAILED")
 
         # Open FAILED files and locate info
-        exe_arns = []
         module_dict = {}
-        for failure in failed_files:
-            module_name = failure.split("/")[0]
-            filename = failure.split("/")[-1]
-            module_dict[module_name] = []
-            with tempfile.TemporaryDirectory() as s3_temp_dir:
-                s3_temp_file = pathlib.Path(s3_temp_dir).joinpath(filename)
-                self.S3.download_file(self.s3_map, failure, s3_temp_file)
-                module_dict[module_name].extend(self.parse_failures(s3_temp_file))
+        for failure, failure_json in self.download_all(failed_files):
+            module_name = failure.partition("/")[0]
+            module_dict.setdefault(module_name, []).extend(self.parse_failures(failure_json))
 
         return module_dict
 
+    def download_all(self, keys):
+        """Download and parse JSON S3 map bucket objects concurrently.
+
+        Parameters:
+        keys (iterable): S3 object keys
+
+        Returns:
+        generator: (key, json_data) for each object in order of keys
+        """
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            yield from executor.map(lambda key: (key, self.fetch_json(key)), keys)
+
+    def fetch_json(self, key):
+        """Download and parse JSON S3 map bucket object in memory.
+
+        Parameters:
+        key (str): S3 object key
+
+        Returns:
+        (object): json_data
+        """
+
+        response = self.s3.get_object(Bucket=self.s3_map, Key=key)
+        with response["Body"] as body:
+            return json_loads(body.read())
+
     def search_files(self, term=""):
-        """Search and return files with term in filename.
+        """Search and yield files with term in filename.
+
+        Filters the map bucket keys from list_map_keys on the client, so the
+        bucket is only listed once per run.
 
         Parameters:
         term (str): String term to search in filename
 
         Returns:
-        list: files
+        generator: files
         """
 
-        paginator = self.S3.get_paginator('list_objects_v2')
+        for key in self.list_map_keys():
+            if term in key:
+                yield key
+
+    def list_map_keys(self):
+        """Yield all S3 map bucket keys page by page.
+
+        The bucket is only listed once; keys are kept after the first complete
+        listing and reused until the bucket is emptied by delete_map.
+
+        Returns:
+        generator: keys
+        """
+
+        if self.map_keys is not None:
+            yield from self.map_keys
+            return
+
+        map_keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
         page_iterator = paginator.paginate(
-            Bucket=self.s3_map
+            Bucket=self.s3_map,
+            PaginationConfig={"PageSize": 1000}
         )
-        items = [key["Key"] for page in page_iterator for key in page["Contents"]]
-        files = [item for item in items if term in item]
-        return files
+        for page in page_iterator:
+            for item in page.get("Contents", []):
+                map_keys.append(item["Key"])
+                yield item["Key"]
+        self.map_keys = map_keys
 
     @staticmethod
-    def parse_failures(failure_file):
-        """Parse JSON failure file for index of failed task.
+    def parse_failures(failure_json):
+        """Parse JSON failure data for index of failed task.
 
         Parameters:
-        failure_file (pathlib.Path): Path to JSON failure file
+        failure_json (list): Data from JSON failure file
         
         Returns:
         list: indexes
         """
 
-        with open(failure_file) as jf:
-            failure_json = json.load(jf)
+        indexes = [Restart.parse_context_index(failure["Input"]) for failure in failure_json if failure["Status"] == "FAILED"]
+        return indexes
 
-        indexes = []
-        for failure in failure_json:
-            if failure["Status"] == "FAILED":
-                indexes.append(json.loads(failure["Input"])["context_index"])
+    @staticmethod
+    def parse_context_index(task_input):
+        """Parse context index from JSON task input.
 
-        return indexes
+        Reads the index with a regular expression and only decodes the full
+        input when it does not match.
+
+        Parameters:
+        task_input (str): JSON task input
+
+        Returns:
+        int: context_index
+        """
+
+        match = Restart.CONTEXT_INDEX.search(task_input)
+        if match:
+            return int(match.group(1))
+        return json_loads(task_input)["context_index"]
 
     def find_failed_identifiers(self, module_dict):
         """Find failed identifiers from appropriate files.
@@ -127,39 +241,104 @@ class Restart:
         module_dict (dict): Dictionary of modules and indexes to remove
         """
 
+        # Several modules share a JSON file so only read each file once
+        file_indexes = {}
         for module, indexes in module_dict.items():
             if len(indexes) == 0: continue
-            reach_ids = self.search_reaches(self.input_dir.joinpath(self.MODULES_JSON[module]), indexes)
+            file_indexes.setdefault(self.MODULES_JSON[module], set()).update(indexes)
+        json_paths = {json_name: self.input_dir.joinpath(json_name) for json_name in file_indexes}
+        json_records = {
+            json_name: self.load_records(json_paths[json_name], indexes)
+            for json_name, indexes in file_indexes.items()
+        }
+
+        for module, indexes in module_dict.items():
+            if len(indexes) == 0: continue
+            json_name = self.MODULES_JSON[module]
+            reach_ids = self.search_reaches(json_paths[json_name], json_records[json_name], indexes)
             self.save_failures[module] = {
-                "json_file": self.MODULES_JSON[module],
+                "json_file": json_name,
                 "indexes": indexes,
                 "reach_ids": reach_ids
             }
 
-    @staticmethod        
-    def search_reaches(json_file, indexes):
-        """Search JSON file for reach_ids at indexes.
+    @staticmethod
+    def load_json(json_file):
+        """Load and return data from JSON file.
+
+        Parameters:
+        json_file (pathlib.Path): Path to JSON file
+
+        Returns:
+        (list): json_data
+        """
+
+        with open(json_file, "rb") as jf:
+            json_data = json_loads(jf.read())
+        return json_data
+
+    @staticmethod
+    def load_records(json_file, indexes):
+        """Load records at indexes from JSON file.
+
+        Streams the file when ijson is available so only the requested records
+        are held in memory.
+
+        Parameters:
+        json_file (pathlib.Path): Path to JSON file
+        indexes (set): Set of indexes
+
+        Returns:
+        (dict): records keyed by index
+        """
+
+        if not ijson:
+            json_data = Restart.load_json(json_file)
+            return {i: json_data[i] for i in indexes}
+
+        records = {}
+        last_index = max(indexes)
+        with open(json_file, "rb") as jf:
+            for i, record in enumerate(ijson.items(jf, "item")):
+                if i in indexes:
+                    records[i] = record
+                if i == last_index: break
+        return records
+
+    def write_json(self, json_file, json_data):
+        """Write data to JSON file and keep serialized data for upload.
 
         Parameters:
         json_file (pathlib.Path): Path to JSON file
+        json_data (object): Data to write
+        """
+
+        json_bytes = json_dumps(json_data)
+        json_file.write_bytes(json_bytes)
+        self.written_json[json_file] = json_bytes
+
+    @staticmethod        
+    def search_reaches(json_file, json_data, indexes):
+        """Search JSON data for reach_ids at indexes.
+
+        Parameters:
+        json_file (pathlib.Path): Path to JSON file the data was loaded from
+        json_data (dict): Records loaded from JSON file keyed by index
         indexes (list): List of indexes
 
         Returns:
         (list): reach_ids
         """
 
-        with open(json_file) as jf:
-            json_data = json.load(jf)
+        json_name = json_file.name
+        if "basin" in json_name:
+            reach_ids = {reach_id for i in indexes for reach_id in json_data[i]["reach_id"]}
+        elif "reaches" in json_name:
+            reach_ids = {json_data[i]["reach_id"] for i in indexes}
+        elif "sets" in json_name:
+            reach_ids = {reach["reach_id"] for i in indexes for reach in json_data[i]}
 
-        if "basin" in str(json_file):
-            reach_ids = [reach_id for i in indexes for reach_id in json_data[i]["reach_id"] ]
-        if "reaches" in str(json_file):
-            reach_ids = [ json_data[i]["reach_id"] for i in indexes ]
-        if "sets" in str(json_file):
-            reach_ids = [reach["reach_id"] for i in indexes for reach in json_data[i]]
-
-        reach_ids = list(set(reach_ids))
-        return reach_ids
+        return list(reach_ids)
 
     def save_failures_json(self):
         """Save failures as JSON to file.
@@ -169,15 +348,19 @@ class Restart:
         """
 
         json_file = self.input_dir.joinpath("failures.json")
-        with open(json_file, "w") as jf:
-            json.dump(self.save_failures, jf, indent=2)
+        self.write_json(json_file, self.save_failures)
         return json_file
 
     def upload_json(self, json_file, s3_type, date_prefix=None):
-        """Upload JSON files to S3 JSON bucket.
+        """Upload JSON file to S3 JSON or config bucket.
 
         Parameters:
-        json_files (pathlib.Path): JSON file to upload
+        json_file (pathlib.Path): JSON file to upload
+        s3_type (str): 'json' to upload to JSON bucket otherwise config bucket
+        date_prefix (str): Optional key prefix to upload under
+
+        Returns:
+        (str): S3 bucket and key of uploaded file
         """
 
         if date_prefix:
@@ -190,10 +373,17 @@ class Restart:
         else:
             s3_bucket = self.s3_config
 
-        self.S3.upload_file(str(json_file),
-                            s3_bucket,
-                            s3_file,
-                            ExtraArgs={"ServerSideEncryption": "aws:kms"})
+        # Files written during this run are uploaded without reading them back from EFS
+        if json_file in self.written_json:
+            self.s3.put_object(Bucket=s3_bucket,
+                               Key=s3_file,
+                               Body=self.written_json[json_file],
+                               ServerSideEncryption="aws:kms")
+        else:
+            self.s3.upload_file(str(json_file),
+                                s3_bucket,
+                                s3_file,
+                                ExtraArgs={"ServerSideEncryption": "aws:kms"})
         return f"{s3_bucket}/{s3_file}"
 
     def remove_reaches(self, json_file):
@@ -203,40 +393,108 @@ class Restart:
         json_file (pathlib.Path): Path to JSON file to remove reaches from
         """
 
-        failed_reach_ids = [str(reach_id) for value in self.save_failures.values() for reach_id in value["reach_ids"]]
+        failed_reach_ids = {str(reach_id) for value in self.save_failures.values() for reach_id in value["reach_ids"]}
 
-        with open(json_file) as jf:
-            json_data = json.load(jf)
-        removed_json_data = [identifier for identifier in json_data if identifier not in failed_reach_ids]
+        json_data = self.load_json(json_file)
+        removed_json_data = [identifier for identifier in json_data if str(identifier) not in failed_reach_ids]
 
         removed_json_file = json_file.parent.joinpath(f"{json_file.name.replace('.json', '')}_{self.random_int}.json")
-        with open(removed_json_file, "w") as jf:
-            json.dump(removed_json_data, jf, indent=2)
+        self.write_json(removed_json_file, removed_json_data)
         return removed_json_file
 
     def create_reach_subset_file(self):
         """Create reach subset file without failed reaches."""
 
-        failed_reach_ids = [reach_id for value in self.save_failures.values() for reach_id in value["reach_ids"]]
+        failed_reach_ids = {reach_id for value in self.save_failures.values() for reach_id in value["reach_ids"]}
 
         reach_file = self.input_dir.joinpath(self.MODULES_JSON["input"])
-        with open(reach_file) as jf:
-            reach_data = json.load(jf)
-        reach_ids = [reach["reach_id"] for reach in reach_data]
-
-        removed_json_data = [identifier for identifier in reach_ids if identifier not in failed_reach_ids]
+        if ijson:
+            with open(reach_file, "rb") as jf:
+                removed_json_data = [identifier for identifier in ijson.items(jf, "item.reach_id") if identifier not in failed_reach_ids]
+        else:
+            reach_data = self.load_json(reach_file)
+            removed_json_data = [reach["reach_id"] for reach in reach_data if reach["reach_id"] not in failed_reach_ids]
         json_file = self.input_dir.joinpath(f"{self.REACHES_OF_INTEREST.replace('.json', '')}_{self.random_int}.json")
-        with open(json_file, "w") as jf:
-            json.dump(removed_json_data, jf, indent=2)
+        self.write_json(json_file, removed_json_data)
         return json_file
 
     def delete_map(self):
-        """Delete all objects in S3 map bucket."""
+        """Delete S3 map bucket objects found by the first listing in this run.
 
-        map_files = self.search_files()
-        delete_files = {"Objects": [ { "Key": file } for file in map_files ]}
-        self.S3.delete_objects(Bucket=self.s3_map, Delete=delete_files)
-        for map_file in map_files: logging.info("Deleted %s bucket object: %s", self.s3_map, map_file)
+        Only keys cached by list_map_keys are deleted; objects written to the
+        bucket after that listing are not. Keys that S3 could not delete are retried once.
+
+        Raises Exception when objects could not be deleted so that execution is
+        not restarted on a partially emptied bucket.
+        """
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.DELETE_WORKERS) as executor:
+            deleted, errors = self.delete_keys(executor, self.search_files())
+            if errors:
+                logging.warning("Retrying deletion of %s %s bucket objects.", len(errors), self.s3_map)
+                retried, errors = self.delete_keys(executor, [error["Key"] for error in errors])
+                deleted += retried
+        logging.info("Deleted %s objects from %s bucket.", deleted, self.s3_map)
+        self.map_keys = None
+
+        if errors:
+            for error in errors: logging.error("Could not delete %s bucket object: %s (%s)", self.s3_map, error["Key"], error["Message"])
+            raise Exception(f"Could not delete {len(errors)} objects from S3, {self.s3_map}, please delete them before restarting execution")
+
+    def delete_keys(self, executor, map_files):
+        """Delete objects from S3 map bucket in concurrent batches.
+
+        Parameters:
+        executor (concurrent.futures.Executor): Executor to delete batches with
+        map_files (iterable): Keys of objects to delete
+
+        Returns:
+        (tuple): number of deleted objects, errors
+        """
+
+        # DeleteObjects accepts at most 1000 keys per request
+        batches = executor.map(self.delete_batch, self.batch_keys(map_files, self.DELETE_BATCH_SIZE))
+        deleted = 0
+        all_errors = []
+        log_keys = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for batch_files, errors in batches:
+            failed = {error["Key"] for error in errors}
+            if log_keys:
+                for map_file in batch_files:
+                    if map_file not in failed: logging.debug("Deleted %s bucket object: %s", self.s3_map, map_file)
+            deleted += len(batch_files) - len(failed)
+            all_errors.extend(errors)
+        return deleted, all_errors
+
+    def delete_batch(self, map_files):
+        """Delete a batch of objects from S3 map bucket.
+
+        Parameters:
+        map_files (list): Keys of objects to delete
+
+        Returns:
+        (tuple): map_files, errors
+        """
+
+        delete_files = {"Objects": [ { "Key": file } for file in map_files ], "Quiet": True}
+        response = self.s3.delete_objects(Bucket=self.s3_map, Delete=delete_files)
+        return map_files, response.get("Errors", [])
+
+    @staticmethod
+    def batch_keys(keys, size):
+        """Group keys into lists of at most size keys.
+
+        Parameters:
+        keys (iterable): Keys to group
+        size (int): Maximum number of keys in a batch
+
+        Returns:
+        generator: batches
+        """
+
+        keys = iter(keys)
+        while batch := list(itertools.islice(keys, size)):
+            yield batch
 
     def restart_execution(self, prefix, version, run_type, tolerated, subset):
         """Restart Step Function execution to skip failures and try again.
@@ -266,7 +524,7 @@ class Restart:
 
         state_machine_arn = ":".join(exe_arn.split(":")[:-1]).replace("execution", "stateMachine")
         name = f"{state_machine_arn.split(':')[-1]}-{self.random_int}"
-        response = self.SFN.start_execution(
+        response = self.sfn.start_execution(
             stateMachineArn=f"arn:aws:states:us-west-2:475312736312:stateMachine:{prefix}-workflow",
             name=name,
             input=json.dumps(input)
@@ -282,25 +540,21 @@ class Restart:
         # Locate "MANIFEST" files
         mainfest_files = self.search_files("manifest")
 
-        # Open manifest files and locate failed map ARN
-        map_arns = []
-        for manifest in mainfest_files:
-            filename = manifest.split("/")[-1]
-            with tempfile.TemporaryDirectory() as s3_temp_dir:
-                s3_temp_file = pathlib.Path(s3_temp_dir).joinpath(filename)
-                self.S3.download_file(self.s3_map, manifest, s3_temp_file)
-                map_arns.append(self.parse_manifest(s3_temp_file))
-
-        # Get top-level exe ARN
-        exe_arns = []
-        for map_arn in map_arns:
-            response = self.SFN.describe_map_run(
-                mapRunArn=map_arn
-            )
-            exe_arns.append(response["executionArn"])
+        # Open manifest files and get top-level exe ARN of each failed map ARN as it is located
+        exe_arns = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            describe_futures = [
+                executor.submit(self.sfn.describe_map_run, mapRunArn=self.parse_manifest(manifest_json))
+                for _, manifest_json in self.download_all(mainfest_files)
+            ]
+            for future in concurrent.futures.as_completed(describe_futures):
+                exe_arns.add(future.result()["executionArn"])
+                if len(exe_arns) > 1:
+                    for pending in describe_futures: pending.cancel()
+                    break
 
         # There should only be one exe ARN that initiated all tasks
-        exe_arn = list(set(exe_arns))
+        exe_arn = list(exe_arns)
         if len(exe_arn) > 1:
             logging.error("Error located more than one exe ARN: %s", exe_arn)
             raise Exception(f"More than one execution ARN has been detected please make sure all previous run files were deleted from S3, {self.s3_map}")
@@ -308,19 +562,16 @@ class Restart:
             return exe_arn[0]
 
     @staticmethod
-    def parse_manifest(manifest_file):
-        """Parse JSON manfiest file for execution ARN.
+    def parse_manifest(manifest_json):
+        """Parse JSON manfiest data for execution ARN.
 
         Parameters:
-        manifest_file (pathlib.Path): Path to JSON manifest file
+        manifest_json (dict): Data from JSON manifest file
 
         Returns:
         str: map_arn
         """
 
-        with open(manifest_file) as jf:
-            manifest_json = json.load(jf)
-
         map_arn = manifest_json["MapRunArn"]
         return map_arn
 
@@ -334,10 +585,13 @@ class Restart:
         (bool): is_empty
         """
 
-        with open(json_file) as jf:
-            data = json.load(jf)
+        # Only the first two non-whitespace bytes are needed to spot an empty list
+        head = b""
+        with open(json_file, "rb") as jf:
+            while len(head) < 2 and (chunk := jf.read(4096)):
+                head += b"".join(chunk.split())[:2 - len(head)]
 
-        if len(data) == 0:
+        if head == b"[]":
             return True
         else:
             return False